@@ -1,11 +1,17 @@
 import codecs
+import functools
 import os
+import pickle
 import sys
+import tempfile
 import tldextract
 import urllib.request
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
+# uses the public suffix list snapshot bundled with tldextract: no network fetch or cache refresh at runtime
+TLD_EXTRACTOR = tldextract.TLDExtract(suffix_list_urls=())
+
 GENERIC_TLDS = set('ad,as,bz,cc,cd,co,dj,fm,io,la,me,ms,nu,sc,sr,su,tv,tk,ws'.split(','))
 ISO2_TO_COUNTRY = {}
 
@@ -19,6 +25,8 @@ def get_data_path(filename, dirtype='', original=False):
         directory = os.path.join(DATA_DIR, 'resources')
     elif dirtype == 'model':
         directory = os.path.join(DATA_DIR, 'fullmodel')
+    elif dirtype == 'cache':
+        directory = os.path.join(DATA_DIR, 'cache')
 
     if original:
         return os.path.join(directory, 'original', filename)
@@ -29,9 +37,10 @@ def set_data_dir(path):
     global DATA_DIR
     DATA_DIR = path
 
+@functools.lru_cache(maxsize=65536)
 def url2registereddomain(url):
     host = url2host(url)
-    parts = tldextract.extract(host)
+    parts = TLD_EXTRACTOR(host)
     return parts.registered_domain
 
 def url2tld(url):
@@ -175,6 +184,40 @@ class GPException(Exception):
 def gp_open(path, mode='r', encoding='utf-8'):
     return enc_open(path, mode, encoding=encoding)
 
+def load_cached(source_path, build, version, cache_name=None):
+    """Return build(), pickled under data/cache so later processes can skip re-parsing source_path.
+
+    The pickle is rebuilt whenever source_path has changed (different path, size or mtime) or the
+    caller's version differs; bump version whenever build() changes what it returns, as the cache
+    directory survives deploys.
+    """
+    if not cache_name: cache_name = os.path.basename(source_path) + '.pkl'
+    cache_path = get_data_path(cache_name, dirtype='cache')
+    st = os.stat(source_path)
+    key = (version, os.path.abspath(source_path), st.st_size, st.st_mtime_ns)
+    try:
+        with open(cache_path, 'rb') as fin:
+            cached_key, data = pickle.load(fin)
+        if cached_key == key:
+            return data
+    except Exception:
+        # missing, truncated or written by incompatible library versions: rebuild
+        pass
+
+    data = build()
+    tmp_path = None
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fout:
+            pickle.dump((key, data), fout, protocol=5)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        warn(f'could not write cache {cache_path}: {e}')
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return data
+
 def url2host(url):
     if not url.startswith('http:') and not url.startswith('https:'):
         url = 'http://' + url
@@ -193,5 +236,30 @@ def test_url2registereddomain():
     assert(url2registereddomain('http://www.ibm.com/foo/bar') == 'ibm.com')
     assert(url2registereddomain('http://foo.bbc.co.uk/foo/bar') == 'bbc.co.uk')
 
+def test_load_cached(tmp_path):
+    source = tmp_path / 'source.tsv'
+    source.write_text('a\tb\n')
+    calls = []
+    def build():
+        calls.append(1)
+        return source.read_text().split('\t')
+    old_dir = DATA_DIR
+    set_data_dir(str(tmp_path))
+    try:
+        assert load_cached(str(source), build, 1) == ['a', 'b\n']
+        assert load_cached(str(source), build, 1) == ['a', 'b\n']
+        assert len(calls) == 1
+        source.write_text('c\td\te\n')
+        assert load_cached(str(source), build, 1) == ['c', 'd', 'e\n']
+        assert len(calls) == 2
+        assert load_cached(str(source), build, 2) == ['c', 'd', 'e\n']
+        assert len(calls) == 3
+        (tmp_path / 'cache' / 'source.tsv.pkl').write_bytes(b'not a pickle')
+        assert load_cached(str(source), build, 2) == ['c', 'd', 'e\n']
+        assert len(calls) == 4
+        assert [f.name for f in (tmp_path / 'cache').iterdir()] == ['source.tsv.pkl']
+    finally:
+        set_data_dir(old_dir)
+
 if __name__ == "__main__":
     update_goldfeatures()
\ No newline at end of file
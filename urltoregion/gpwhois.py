@@ -18,8 +18,10 @@ only used as a last resort.
 """
 
 import collections
+import contextlib
 import os
 import re
+import threading
 import time
 
 import whois  # pip library, not this file
@@ -28,6 +30,25 @@ from urltoregion import pythonwhois
 from urltoregion.gputils import *
 from urltoregion.country import read_countries
 
+# whois servers rate-limit aggressively, so network lookups are serialized and throttled within a
+# process; cache hits don't take the lock
+WHOIS_LOCK = threading.Lock()
+# per-thread event that, once set, stops add_to_cache from starting new network lookups
+_CANCEL = threading.local()
+
+@contextlib.contextmanager
+def cancellable_lookups(cancelled):
+    """Skip whois network lookups started on this thread once the `cancelled` event is set.
+
+    Skipped lookups raise GPException and leave the cache untouched, so the domain is looked up again later.
+    """
+    _CANCEL.event = cancelled
+    try:
+        yield
+    finally:
+        _CANCEL.event = None
+
+
 class WhoisProvider:
     """
         A provided that resolves countries associated with a whois record.
@@ -53,13 +74,14 @@ class WhoisProvider:
                 if not whois:
                     self.cache[domain] = {}
                 elif whois.endswith('|p'):
-                    country = whois[:-2]
+                    # country names repeat across hundreds of thousands of domains: share one string each
+                    country = sys.intern(whois[:-2])
                     if country != '??': self.cache[domain] = country
                 else:
                     dist = {}
                     for pair in whois.split(';'):
                         (country, n) = pair.split('|')
-                        dist[country] = int(n)
+                        dist[sys.intern(country)] = int(n)
                     total = 1.0 * sum(dist.values())
                     if total > 0:
                         for c in dist: dist[c] /= total
@@ -104,39 +126,46 @@ class WhoisProvider:
         return self.cache[d]
 
     def add_to_cache(self, domain, first_attempt=True):
-        try:
-            warn(f'Running whois lookup for {domain}...')
-            raw = retrieve_whois_record(domain, first_attempt=first_attempt)
-            time.sleep(0.25)  # don't hammer WHOIS API
-        except Exception:
-            warn(f'whois lookup for {domain} failed: {sys.exc_info()[1]}')
-            self.cache[domain] = {}
-            self.add_cache_line(domain + '\t')
-            return
+        with WHOIS_LOCK:
+            if domain in self.cache:
+                return  # looked up by another thread while this one waited
+            cancelled = getattr(_CANCEL, 'event', None)
+            if cancelled is not None and cancelled.is_set():
+                raise GPException(f'whois lookup for {domain} cancelled')
+            try:
+                warn(f'Running whois lookup for {domain}...')
+                raw = retrieve_whois_record(domain, first_attempt=first_attempt)
+                time.sleep(0.25)  # don't hammer WHOIS API
+            except Exception:
+                warn(f'whois lookup for {domain} failed: {sys.exc_info()[1]}')
+                # not written to the cache file: network errors (e.g., rate limiting) say nothing
+                # about the domain, so it is retried once the process restarts
+                self.cache[domain] = {}
+                return
 
-        try:
-            parsed = extract_parsed_whois_country(raw, self.aliases, domain)
-            if parsed:
-                self.cache[domain] = parsed
-                self.add_cache_line(domain + '\t' + parsed + '|p')
+            try:
+                parsed = extract_parsed_whois_country(raw, self.aliases, domain)
+                if parsed:
+                    self.cache[domain] = parsed
+                    self.add_cache_line(domain + '\t' + parsed + '|p')
+                    return
+            except Exception:
+                warn(f'parsing of whois record for {domain} failed: {sys.exc_info()[1]}. Resorting to freetext method.')
+
+            freetext = extract_freetext_whois_country(raw, self.regexes)
+            if freetext:
+                self.cache[domain] = freetext
+                pairs = [f'{cc}|{n}' for (cc, n) in freetext.items()]
+                self.add_cache_line(domain + '\t' + ';'.join(pairs))
                 return
-        except Exception:
-            warn(f'parsing of whois record for {domain} failed: {sys.exc_info()[1]}. Resorting to freetext method.')
-
-        freetext = extract_freetext_whois_country(raw, self.regexes)
-        if freetext:
-            self.cache[domain] = freetext
-            pairs = [f'{cc}|{n}' for (cc, n) in freetext.items()]
-            self.add_cache_line(domain + '\t' + ';'.join(pairs))
-            return
-
-        warn(f'add_to_cache failed for {domain}. Raw record: {raw}\n')
-        # NOTE: can check first_attempt and if True do: self.add_to_cache(domain, first_attempt=False)
-        # and otherwise proceed with updating the cache.
-        # This would re-run the WHOIS lookup with a different method and sometimes helps.
-        # The second method is also less reliable and can hang-up
-        self.cache[domain] = {}
-        self.add_cache_line(domain + '\t')
+
+            warn(f'add_to_cache failed for {domain}. Raw record: {raw}\n')
+            # NOTE: can check first_attempt and if True do: self.add_to_cache(domain, first_attempt=False)
+            # and otherwise proceed with updating the cache.
+            # This would re-run the WHOIS lookup with a different method and sometimes helps.
+            # The second method is also less reliable and can hang-up
+            self.cache[domain] = {}
+            self.add_cache_line(domain + '\t')
 
     def add_cache_line(self, line):
         with gp_open(self.cache_path, 'a') as f:
@@ -1,5 +1,5 @@
 from __future__ import print_function
-import os, re, sys, datetime, csv
+import os, re, sys, datetime, csv, functools
 from . import net, shared
 
 try:
@@ -413,6 +413,8 @@ billing_contact_regexes = precompile_regexes(billing_contact_regexes)
 admin_contact_regexes = precompile_regexes(admin_contact_regexes)
 nic_contact_regexes = precompile_regexes(nic_contact_regexes)
 organization_regexes = precompile_regexes(organization_regexes, re.IGNORECASE)
+# First whitespace-delimited token of an indented line (.am and TWNIC nameserver lists)
+nameserver_line_regex = re.compile(r"      [^\S\n]*(\S+).*\n")
 
 nic_contact_references["registrant"] = precompile_regexes(nic_contact_references["registrant"])
 nic_contact_references["tech"] = precompile_regexes(nic_contact_references["tech"])
@@ -502,13 +504,7 @@ def parse_raw_whois(raw_data, normalized=None, never_query_handles=True, handle_
 		# .am plays the same game
 		match = re.search(r"   DNS servers:([\s\S]*?\n)\n", segment)
 		if match is not None:
-			chunk = match.group(1)
-			for match in re.findall("      (.+)\n", chunk):
-				match = match.split()[0]
-				try:
-					data["nameservers"].append(match.strip())
-				except KeyError as e:
-					data["nameservers"] = [match.strip()]
+			data.setdefault("nameservers", []).extend(nameserver_line_regex.findall(match.group(1)))
 		# SIDN isn't very standard either. And EURid uses a similar format.
 		match = re.search(r"Registrar:\n\s+(?:Name:\s*)?(\S.*)", segment)
 		if match is not None:
@@ -545,13 +541,7 @@ def parse_raw_whois(raw_data, normalized=None, never_query_handles=True, handle_
 		# ... and again for TWNIC.
 		match = re.search(r"   Domain servers in listed order:\n([\s\S]*?\n)\n", segment)
 		if match is not None:
-			chunk = match.group(1)
-			for match in re.findall("      (.+)\n", chunk):
-				match = match.split()[0]
-				try:
-					data["nameservers"].append(match.strip())
-				except KeyError as e:
-					data["nameservers"] = [match.strip()]
+			data.setdefault("nameservers", []).extend(nameserver_line_regex.findall(match.group(1)))
 
 
 	data["contacts"] = parse_registrants(raw_data, never_query_handles, handle_server)
@@ -610,14 +600,16 @@ def parse_raw_whois(raw_data, normalized=None, never_query_handles=True, handle_
 
 	data["raw"] = raw_data
 
-	if normalized != []:
+	if normalized:
 		data = normalize_data(data, normalized)
 
 	return data
 
 def normalize_data(data, normalized):
+	if normalized is not True:
+		normalized = frozenset(normalized) # Checked for every field of every contact
 	for key in ("nameservers", "emails", "whois_server"):
-		if key in data and data[key] is not None and (normalized == True or key in normalized):
+		if key in data and data[key] is not None and (normalized is True or key in normalized):
 			if is_string(data[key]):
 				data[key] = data[key].lower()
 			else:
@@ -628,7 +620,7 @@ def normalize_data(data, normalized):
 			ignore_nic = True
 		else:
 			ignore_nic = False
-		if key in data and data[key] is not None and (normalized == True or key in normalized):
+		if key in data and data[key] is not None and (normalized is True or key in normalized):
 			if is_string(data[key]):
 				data[key] = normalize_name(data[key], abbreviation_threshold=threshold, length_threshold=1, ignore_nic=ignore_nic)
 			else:
@@ -641,23 +633,24 @@ def normalize_data(data, normalized):
 			if 'city' in contact and contact['city'] in airports:
 				contact['city'] = airports[contact['city']]
 			if 'country' in contact and 'state' in contact:
+				country_lower = contact["country"].lower()
 				for country, source in (("united states", states_us), ("australia", states_au), ("canada", states_ca)):
-					if country in contact["country"].lower() and contact["state"] in source:
+					if country in country_lower and contact["state"] in source:
 						contact["state"] = source[contact["state"]]
 
 			for key in ("email",):
-				if key in contact and contact[key] is not None and (normalized == True or key in normalized):
+				if key in contact and contact[key] is not None and (normalized is True or key in normalized):
 					if is_string(contact[key]):
 						contact[key] = contact[key].lower()
 					else:
 						contact[key] = [item.lower() for item in contact[key]]
 
 			for key in ("name", "street"):
-				if key in contact and contact[key] is not None and (normalized == True or key in normalized):
+				if key in contact and contact[key] is not None and (normalized is True or key in normalized):
 					contact[key] = normalize_name(contact[key], abbreviation_threshold=3)
 
 			for key in ("city", "organization", "state", "country"):
-				if key in contact and contact[key] is not None and (normalized == True or key in normalized):
+				if key in contact and contact[key] is not None and (normalized is True or key in normalized):
 					contact[key] = normalize_name(contact[key], abbreviation_threshold=3, length_threshold=3)
 
 			if "name" in contact and "organization" not in contact:
@@ -687,12 +680,14 @@ def normalize_data(data, normalized):
 							break
 
 			for key in list(contact.keys()):
-				try:
-					contact[key] = contact[key].strip(", ")
-					if contact[key] == "-" or contact[key].lower() == "n/a":
-						del contact[key]
-				except AttributeError as e:
-					pass # Not a string
+				value = contact[key]
+				if not is_string(value):
+					continue # eg. parsed dates
+				value = value.strip(", ")
+				if value == "-" or value.lower() == "n/a":
+					del contact[key]
+				else:
+					contact[key] = value
 	return data
 
 def normalize_name(value, abbreviation_threshold=4, length_threshold=8, lowercase_domains=True, ignore_nic=False):
@@ -740,82 +735,80 @@ def normalize_name(value, abbreviation_threshold=4, length_threshold=8, lowercas
 	return "\n".join(normalized_lines)
 
 def parse_dates(dates):
-	global grammar
-	parsed_dates = []
-
-	for date in dates:
-		for rule in grammar['_dateformats']:
-			result = re.match(rule, date)
-
-			if result is not None:
-				try:
-					# These are always numeric. If they fail, there is no valid date present.
-					year = int(result.group("year"))
-					day = int(result.group("day"))
+	parsed_dates = [parse_date(date) for date in dates]
+	parsed_dates = [date for date in parsed_dates if date is not None]
 
-					# Detect and correct shorthand year notation
-					if year < 60:
-						year += 2000
-					elif year < 100:
-						year += 1900
+	if len(parsed_dates) > 0:
+		return parsed_dates
+	else:
+		return None
 
-					# This will require some more guesswork - some WHOIS servers present the name of the month
-					try:
-						month = int(result.group("month"))
-					except ValueError as e:
-						# Apparently not a number. Look up the corresponding number.
-						try:
-							month = grammar['_months'][result.group("month").lower()]
-						except KeyError as e:
-							# Unknown month name, default to 0
-							month = 0
+@functools.lru_cache(maxsize=16384)
+def parse_date(date):
+	# Memoized: registrars echo the same date strings across many records.
+	for rule in grammar['_dateformats']:
+		result = rule.match(date)
 
-					try:
-						hour = int(result.group("hour"))
-					except IndexError as e:
-						hour = 0
-					except TypeError as e:
-						hour = 0
+		if result is not None:
+			try:
+				# These are always numeric. If they fail, there is no valid date present.
+				year = int(result.group("year"))
+				day = int(result.group("day"))
 
-					try:
-						minute = int(result.group("minute"))
-					except IndexError as e:
-						minute = 0
-					except TypeError as e:
-						minute = 0
+				# Detect and correct shorthand year notation
+				if year < 60:
+					year += 2000
+				elif year < 100:
+					year += 1900
 
+				# This will require some more guesswork - some WHOIS servers present the name of the month
+				try:
+					month = int(result.group("month"))
+				except ValueError as e:
+					# Apparently not a number. Look up the corresponding number.
 					try:
-						second = int(result.group("second"))
-					except IndexError as e:
-						second = 0
-					except TypeError as e:
-						second = 0
+						month = grammar['_months'][result.group("month").lower()]
+					except KeyError as e:
+						# Unknown month name, default to 0
+						month = 0
 
-					break
-				except ValueError as e:
-					# Something went horribly wrong, maybe there is no valid date present?
-					year = 0
-					month = 0
-					day = 0
+				try:
+					hour = int(result.group("hour"))
+				except IndexError as e:
+					hour = 0
+				except TypeError as e:
 					hour = 0
+
+				try:
+					minute = int(result.group("minute"))
+				except IndexError as e:
 					minute = 0
-					second = 0
-					print(e.message) # FIXME: This should have proper logging of some sort...?
-		try:
-			if year > 0:
+				except TypeError as e:
+					minute = 0
+
 				try:
-					parsed_dates.append(datetime.datetime(year, month, day, hour, minute, second))
-				except ValueError as e:
-					# We might have gotten the day and month the wrong way around, let's try it the other way around
-					# If you're not using an ISO-standard date format, you're an evil registrar!
-					parsed_dates.append(datetime.datetime(year, day, month, hour, minute, second))
-		except UnboundLocalError as e:
-			pass
+					second = int(result.group("second"))
+				except IndexError as e:
+					second = 0
+				except TypeError as e:
+					second = 0
 
-	if len(parsed_dates) > 0:
-		return parsed_dates
+				break
+			except ValueError as e:
+				# Something went horribly wrong, maybe there is no valid date present?
+				year = 0
+				print(e) # FIXME: This should have proper logging of some sort...?
 	else:
-		return None
+		return None # No matching date format
+
+	if year > 0:
+		try:
+			return datetime.datetime(year, month, day, hour, minute, second)
+		except ValueError as e:
+			# We might have gotten the day and month the wrong way around, let's try it the other way around
+			# If you're not using an ISO-standard date format, you're an evil registrar!
+			return datetime.datetime(year, day, month, hour, minute, second)
+	return None
 
 def remove_duplicates(data):
 	cleaned_list = []
@@ -836,39 +829,26 @@ def remove_suffixes(data):
 
 	return cleaned_list
 
-def parse_registrants(data, never_query_handles=True, handle_server=""):
-	registrant = None
-	tech_contact = None
-	billing_contact = None
-	admin_contact = None
-
-	for segment in data:
-		for regex in registrant_regexes:
-			match = re.search(regex, segment)
-			if match is not None:
-				registrant = match.groupdict()
-				break
-
-	for segment in data:
-		for regex in tech_contact_regexes:
-			match = re.search(regex, segment)
-			if match is not None:
-				tech_contact = match.groupdict()
-				break
-
-	for segment in data:
-		for regex in admin_contact_regexes:
-			match = re.search(regex, segment)
+def pop_numbered_fields(obj, prefix):
+	# Removes eg. street1, street2, ... from a contact and returns their values in numeric order.
+	offset = len(prefix)
+	keys = sorted((key for key in obj if key.startswith(prefix) and key[offset:].isdigit()), key=lambda key: int(key[offset:]))
+	return [obj.pop(key) for key in keys]
+
+def find_contact(data, regexes):
+	# The last segment with a match wins, so scan backwards and stop at the first one found.
+	for segment in reversed(data):
+		for regex in regexes:
+			match = regex.search(segment)
 			if match is not None:
-				admin_contact = match.groupdict()
-				break
+				return match.groupdict()
+	return None
 
-	for segment in data:
-		for regex in billing_contact_regexes:
-			match = re.search(regex, segment)
-			if match is not None:
-				billing_contact = match.groupdict()
-				break
+def parse_registrants(data, never_query_handles=True, handle_server=""):
+	registrant = find_contact(data, registrant_regexes)
+	tech_contact = find_contact(data, tech_contact_regexes)
+	billing_contact = find_contact(data, billing_contact_regexes)
+	admin_contact = find_contact(data, admin_contact_regexes)
 
 	# Find NIC handle contact definitions
 	handle_contacts = parse_nic_contact(data)
@@ -923,28 +903,11 @@ def parse_registrants(data, never_query_handles=True, handle_server=""):
 				if "phone" in obj:
 					obj["phone"] += " ext. %s" % obj["phone_ext"]
 					del obj["phone_ext"]
-			if "street1" in obj:
-				street_items = []
-				i = 1
-				while True:
-					try:
-						street_items.append(obj["street%d" % i])
-						del obj["street%d" % i]
-					except KeyError as e:
-						break
-					i += 1
+			street_items = pop_numbered_fields(obj, "street")
+			if street_items:
 				obj["street"] = "\n".join(street_items)
-			if "organization1" in obj: # This is to deal with eg. HKDNR, who allow organization names in multiple languages.
-				organization_items = []
-				i = 1
-				while True:
-					try:
-						if obj["organization%d" % i].strip() != "":
-							organization_items.append(obj["organization%d" % i])
-							del obj["organization%d" % i]
-					except KeyError as e:
-						break
-					i += 1
+			organization_items = pop_numbered_fields(obj, "organization") # This is to deal with eg. HKDNR, who allow organization names in multiple languages.
+			if organization_items:
 				obj["organization"] = "\n".join(organization_items)
 			if 'changedate' in obj:
 				obj['changedate'] = parse_dates([obj['changedate']])[0]
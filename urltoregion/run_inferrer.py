@@ -18,7 +18,6 @@ from urltoregion.gpinfer import LogisticInferrer
 
 
 def main(inferrer, input, output):
-    format = lambda x: '%.4f' % x
     for line in input:
         url = line.split()[0]
         if not url:
@@ -29,13 +28,8 @@ def main(inferrer, input, output):
                 items = list(dist.items())
                 items.sort(key=lambda x: x[1], reverse=True)
                 (maxcountry, maxp) = items[0]
-                json = '{'
-                for (i, (c, p)) in enumerate(items[:10]):
-                    if i != 0:
-                        json += ', '
-                    json += "'%s' : %s" % (c, format(p))
-                json += '}'
-                output.write(url + '\t' + maxcountry + '\t' + format(maxp) + '\t' + json + '\n')
+                top = ', '.join("'%s' : %.4f" % (c, p) for (c, p) in items[:10])
+                output.write('%s\t%s\t%.4f\t{%s}\n' % (url, maxcountry, maxp, top))
                 output.flush()
             else:
                 output.write(url + '\tunknown\t0.0\t{}\n')
@@ -1,6 +1,12 @@
+import functools
+
 from urltoregion.gputils import *
 from urltoregion.country import read_countries
 
+# keyed on the full URL string, so this only pays off in batch runs (e.g., run_inferrer) where the same
+# URLs recur; the API already memoizes whole inferences per registered domain (wsgi.domain_to_region)
+_url2tld = functools.lru_cache(maxsize=65536)(url2tld)
+
 class TldFeature:
     def __init__(self, countries=None):
         if not countries: countries = read_countries()
@@ -8,7 +14,7 @@ class TldFeature:
         self.tld_countries = dict([(c.tld, c) for c in countries if c.tld is not None])
 
     def infer(self, url):
-        tld = url2tld(url)
+        tld = _url2tld(url)
         if tld not in GENERIC_TLDS and tld in self.tld_countries:
             name = self.tld_countries[tld].name
             return (0.95, { name : 1.0 })
@@ -9,11 +9,18 @@ Adapted by: Isaac Johnson
 
 """
 import csv
+import gzip
+import hashlib
 import json
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import requests
-
+import shapely
 from shapely.geometry import shape, Point
+from shapely.strtree import STRtree
 
 # Sometimes needed to run scripts locally... Not sure why...
 #import sys
@@ -23,6 +30,51 @@ from urltoregion.gputils import *
 
 WIKIDATA_HEADER = ['domain', 'lat', 'lon', 'country']
 PUBLISHER_HEADER = ['publisher', 'country']
+WIKIDATA_CACHE_VERSION = 1  # bump when read_wikidata_countries changes its output
+WDQS_CACHE_MAX_AGE = 7 * 24 * 60 * 60  # seconds before cached WDQS results are revalidated
+
+def domain_fingerprint(domain):
+    """64-bit fingerprint of a domain used to key the compact wikidata lookup table."""
+    return int.from_bytes(hashlib.blake2b(domain.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def read_wikidata_countries(path):
+    """Parse wikidata_countries.tsv into (sorted domain fingerprints, country indices, country names)."""
+    warn('reading wikidata results...')
+    domains = {}
+    # plain split rather than csv.reader: fields are never quoted (domains, floats, country names)
+    # and the ~250 distinct country names are interned so the 500k values share them
+    with open(path, 'r', newline='') as fin:
+        assert next(fin).rstrip('\r\n').split('\t') == WIKIDATA_HEADER
+        expected_num_columns = len(WIKIDATA_HEADER)
+        domain_idx = WIKIDATA_HEADER.index('domain')
+        country_idx = WIKIDATA_HEADER.index('country')
+        for line in fin:
+            line = line.rstrip('\r\n').split('\t')
+            if len(line) == expected_num_columns:
+                domain = line[domain_idx]
+                country = sys.intern(line[country_idx])
+                domains[domain] = country
+            else:
+                warn(f'invalid wikidata line: {line}')
+    warn(f'finished reading {len(domains)} wikidata entries')
+
+    # a few known data quality issues -- largely arising from duplicates of URL domains
+    # TODO: better approach that doesn't include domains with high ambiguity?
+    domains['ibm.com'] = 'United States of America'
+    domains['nytimes.com'] = 'United States of America'
+
+    # compact the mapping: sorted 64-bit domain fingerprints with a parallel array of indices
+    # into the (small) table of country names -- a few MB instead of a 500k-entry dict
+    countries = sorted(set(domains.values()))
+    country_index = {c: i for i, c in enumerate(countries)}
+    hashes = np.fromiter((domain_fingerprint(d) for d in domains), dtype=np.uint64, count=len(domains))
+    indices = np.fromiter((country_index[c] for c in domains.values()), dtype=np.int16, count=len(domains))
+    order = np.argsort(hashes)
+    domain_hashes = hashes[order]
+    country_idx = indices[order]
+    if np.any(domain_hashes[1:] == domain_hashes[:-1]):
+        warn('wikidata domain fingerprint collision; lookups for the colliding domains may be wrong')
+    return domain_hashes, country_idx, countries
 
 class WikidataProvider:
     """
@@ -36,34 +88,21 @@ class WikidataProvider:
         if not os.path.isfile(cache_path):
             raise GPException('wikidata results not available...')
 
-        warn('reading wikidata results...')
-        self.domains = {}
-        with open(cache_path, 'r') as fin:
-            tsvreader = csv.reader(fin, delimiter='\t')
-            assert next(tsvreader) == WIKIDATA_HEADER
-            expected_num_columns = len(WIKIDATA_HEADER)
-            domain_idx = WIKIDATA_HEADER.index('domain')
-            country_idx = WIKIDATA_HEADER.index('country')
-            for line in tsvreader:
-                if len(line) == expected_num_columns:
-                    domain = line[domain_idx]
-                    country = line[country_idx]
-                    self.domains[domain] = country
-                else:
-                    warn(f'invalid wikidata line: {line}')
-        warn(f'finished reading {len(self.domains)} wikidata entries')
-
-        # a few known data quality issues -- largely arising from duplicates of URL domains
-        # TODO: better approach that doesn't include domains with high ambiguity?
-        self.domains['ibm.com'] = 'United States of America'
-        self.domains['nytimes.com'] = 'United States of America'
+        self.domain_hashes, self.country_idx, self.countries = load_cached(
+            cache_path, lambda: read_wikidata_countries(cache_path), WIKIDATA_CACHE_VERSION)
 
+    def get_domain(self, domain):
+        h = np.uint64(domain_fingerprint(domain))
+        i = np.searchsorted(self.domain_hashes, h)
+        if i < len(self.domain_hashes) and self.domain_hashes[i] == h:
+            return self.countries[self.country_idx[i]]
+        return None
 
     def get(self, url):
         domain = url2registereddomain(url)
         if not domain:
             return None
-        country = self.domains.get(domain)
+        country = self.get_domain(domain)
         if country:
             return country
         else:
@@ -96,9 +135,24 @@ def test_coord_to_country():
                                     aggregation_tsv=get_data_path('country_aggregation.tsv', dirtype='country'))
     assert(coord_to_country(region_shapes, 55.309444, 25.269722) == 'United Arab Emirates')
 
-def rebuild():
+def test_coords_to_countries():
+    region_shapes = get_region_data(region_qids_tsv=get_data_path('base_regions_qids.tsv', dirtype='country'),
+                                    region_geoms_geojson=get_data_path('ne_10m_admin_0_map_units.geojson', dirtype='country'),
+                                    aggregation_tsv=get_data_path('country_aggregation.tsv', dirtype='country'))
+    rng = np.random.default_rng(0)
+    lons = rng.uniform(-180, 180, 500)
+    lats = rng.uniform(-60, 75, 500)
+    expected = [coord_to_country(region_shapes, lon, lat) for lon, lat in zip(lons, lats)]
+    assert(any(expected) and not all(expected))
+    for workers in (1, 4):
+        assert(list(coords_to_countries(region_shapes, lons, lats, workers=workers)) == expected)
+    assert(len(coords_to_countries(region_shapes, np.array([]), np.array([]))) == 0)
+
+def rebuild(max_age=WDQS_CACHE_MAX_AGE):
     """Rebuild cache of URLs -> coordinates from Wikidata.
 
+    WDQS results cached in data/cache are reused for up to `max_age` seconds; pass max_age=0 to
+    pick up recent Wikidata edits.
     """
     region_shapes = get_region_data(region_qids_tsv=get_data_path('base_regions_qids.tsv', dirtype='country'),
                                     region_geoms_geojson=get_data_path('ne_10m_admin_0_map_units.geojson', dirtype='country'),
@@ -128,13 +182,6 @@ def rebuild():
 
     # TODO: challenge that many multinational companies have multiple domain names and only the first is used so e.g.,
     # ibm.com/sweden -> Sweden becomes the gold data for IBM
-    print("Querying WDQS...")
-    r = requests.get("https://query.wikidata.org/sparql",
-                     params={'format': 'json', 'query': website_query},
-                     headers={'User-Agent': 'isaac@wikimedia.org; geoprovenance'})
-    results = r.json()
-    all_data = results['results']['bindings']
-    print(f"{len(all_data)} URLs retrieved.")
     seen = set()
     written = 0
     not_found = 0
@@ -144,44 +191,53 @@ def rebuild():
     already_seen = 0
 
     print("Processing results...")
+    rows = []  # (domain, lat, lon) for each unique domain
+    lons = []
+    lats = []
+    for i, website in enumerate(query_wdqs(website_query, max_age=max_age), start=1):
+        if i % 50000 == 0:
+            print((f"{i} URLs processed. "
+                   f"{already_seen} skipped as duplicates. "
+                   f"{no_domain} no domain after parsing URL. "
+                   f"{invalid_coords} had invalid coordinates. "
+                   f"{invalid_sparql} had invalid sparql."))
+        try:
+            url = website['websiteurl']['value']
+            domain = url2registereddomain(url)
+            if domain in seen:
+                already_seen += 1
+                continue
+            elif not domain:
+                no_domain += 1
+                continue
+            seen.add(domain)
+
+            coords = website['coords']['value']
+            lon, lat = coords.replace("Point", "")[1:-1].split()  # ex: Point(14.4690742 50.0674744)
+            try:
+                lon_lat = (float(lon), float(lat))
+            except ValueError:
+                invalid_coords += 1
+                continue
+            rows.append((domain, lat, lon))
+            lons.append(lon_lat[0])
+            lats.append(lon_lat[1])
+        except Exception:
+            invalid_sparql += 1
+
+    # geolocate all of the coordinates at once rather than one point at a time
+    print(f"Geolocating {len(rows)} coordinates...")
+    countries = coords_to_countries(region_shapes, np.array(lons), np.array(lats))
+
     with open(get_data_path('wikidata_countries.tsv', dirtype='model'), 'w') as fout:
         tsvwriter = csv.writer(fout, delimiter='\t')
         tsvwriter.writerow(WIKIDATA_HEADER)
-        for i, website in enumerate(all_data, start=1):
-            if i % 50000 == 0:
-                print((f"{i} URLs processed. "
-                       f"{already_seen} skipped as duplicates. "
-                       f"{written} written. "
-                       f"{no_domain} no domain after parsing URL. "
-                       f"{not_found} had coordinates but no country found. "
-                       f"{invalid_coords} had invalid coordinates. "
-                       f"{invalid_sparql} had invalid sparql."))
-            try:
-                url = website['websiteurl']['value']
-                domain = url2registereddomain(url)
-                if domain in seen:
-                    already_seen += 1
-                    continue
-                elif not domain:
-                    no_domain += 1
-                    continue
-                seen.add(domain)
-
-                coords = website['coords']['value']
-                lon, lat = coords.replace("Point", "")[1:-1].split()  # ex: Point(14.4690742 50.0674744)
-                try:
-                    country = coord_to_country(region_shapes, float(lon), float(lat))
-                except Exception:
-                    invalid_coords += 1
-                    continue
-
-                if country is not None:
-                    tsvwriter.writerow([domain, lat, lon, country])
-                    written += 1
-                else:
-                    not_found += 1
-            except Exception:
-                invalid_sparql += 1
+        for (domain, lat, lon), country in zip(rows, countries):
+            if country is not None:
+                tsvwriter.writerow([domain, lat, lon, country])
+                written += 1
+            else:
+                not_found += 1
 
     print((f"Complete! {i} URLs processed. "
            f"{already_seen} skipped as duplicates. "
@@ -191,8 +247,12 @@ def rebuild():
            f"{invalid_coords} had invalid coordinates. "
            f"{invalid_sparql} had invalid sparql."))
 
-def get_publishers():
-    """Build cache of Publishers -> Countries from Wikidata."""
+def get_publishers(max_age=WDQS_CACHE_MAX_AGE):
+    """Build cache of Publishers -> Countries from Wikidata.
+
+    WDQS results cached in data/cache are reused for up to `max_age` seconds; pass max_age=0 to
+    pick up recent Wikidata edits.
+    """
     from urltoregion.gpinfer import LogisticInferrer as LR
     import time
 
@@ -225,13 +285,6 @@ def get_publishers():
     }
     """
 
-    print("Querying WDQS...")
-    r = requests.get("https://query.wikidata.org/sparql",
-                     params={'format': 'json', 'query': website_query},
-                     headers={'User-Agent': 'isaac@wikimedia.org; geoprovenance'})
-    results = r.json()
-    all_data = results['results']['bindings']
-    print(f"{len(all_data)} publishers retrieved.")
     seen = set()
     written = 0
     not_found = 0
@@ -245,7 +298,7 @@ def get_publishers():
     with open(get_data_path('wikidata_publisher_countries_INT.tsv', dirtype='model'), 'w') as fout:
         tsvwriter = csv.writer(fout, delimiter='\t')
         tsvwriter.writerow(PUBLISHER_HEADER)
-        for i, publisher in enumerate(all_data, start=1):
+        for i, publisher in enumerate(query_wdqs(website_query, max_age=max_age), start=1):
             if i % 5000 == 0:
                 print((f"{i} publishers processed. "
                        f"{already_seen} skipped as duplicates. "
@@ -329,6 +382,69 @@ def get_publishers():
             if publisher not in to_remove:
                 tsvwriter.writerow([publisher, country])
 
+def query_wdqs(query, max_age=WDQS_CACHE_MAX_AGE):
+    """Stream the result bindings of a SPARQL query against WDQS.
+
+    Results are parsed incrementally as they arrive so the (very large) response never has to be held in memory.
+    The raw response is also cached (gzipped) in data/cache, keyed on the query, so that re-running a rebuild
+    skips the query. Cached results older than `max_age` seconds are revalidated against WDQS.
+    """
+    import ijson  # only needed for rebuilding the Wikidata caches
+
+    cache_path = get_data_path(f'wdqs_{hashlib.sha1(query.encode("utf-8")).hexdigest()}.json.gz', dirtype='cache')
+    validators_path = cache_path + '.headers'
+    headers = {'User-Agent': 'isaac@wikimedia.org; geoprovenance'}
+    if os.path.isfile(cache_path):
+        if time.time() - os.path.getmtime(cache_path) < max_age:
+            print(f"Using cached WDQS results: {cache_path}")
+            with gzip.open(cache_path, 'rb') as fin:
+                yield from ijson.items(fin, 'results.bindings.item')
+            return
+        elif os.path.isfile(validators_path):
+            with open(validators_path, 'r') as fin:
+                validators = json.load(fin)
+            if 'ETag' in validators:
+                headers['If-None-Match'] = validators['ETag']
+            if 'Last-Modified' in validators:
+                headers['If-Modified-Since'] = validators['Last-Modified']
+
+    print("Querying WDQS...")
+    with requests.get("https://query.wikidata.org/sparql",
+                      params={'format': 'json', 'query': query},
+                      headers=headers,
+                      stream=True) as r:
+        if r.status_code == 304:
+            print(f"WDQS results unchanged. Using cached WDQS results: {cache_path}")
+            os.utime(cache_path)
+        else:
+            r.raise_for_status()
+            r.raw.decode_content = True  # let urllib3 undo any gzip transfer encoding
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            # write to the cache as the response is parsed; only kept if the whole response is read
+            with gzip.open(cache_path + '.tmp', 'wb') as fout:
+                response = CachingReader(r.raw, fout)
+                yield from ijson.items(response, 'results.bindings.item')
+                while response.read(65536):
+                    pass
+            os.replace(cache_path + '.tmp', cache_path)
+            with open(validators_path, 'w') as fout:
+                json.dump({h: r.headers[h] for h in ('ETag', 'Last-Modified') if h in r.headers}, fout)
+            return
+
+    with gzip.open(cache_path, 'rb') as fin:
+        yield from ijson.items(fin, 'results.bindings.item')
+
+class CachingReader:
+    """File-like wrapper that copies everything read from `source` into `cache`."""
+    def __init__(self, source, cache):
+        self.source = source
+        self.cache = cache
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        self.cache.write(data)
+        return data
+
 def get_qid_to_region(region_qids_tsv, aggregation_tsv):
     # load in base regions
     qid_to_region = {}
@@ -355,19 +471,54 @@ def get_qid_to_region(region_qids_tsv, aggregation_tsv):
 def coord_to_country(region_shapes, lon, lat):
     """Determine which region contains a lat-lon coordinate.
 
-    Depends on shapely library and region_shapes object, which contains a dictionary
-    mapping QIDs to shapely geometry objects.
+    Depends on shapely library and region_shapes object (from `get_region_data`), which contains
+    the region names, their shapely geometries, and a spatial index over those geometries.
     """
     try:
-        pt = Point(lon, lat)
-        for region_name, region_shape in region_shapes:
-            if region_shape.contains(pt):
-                return region_name
+        region_names, region_geoms, region_tree = region_shapes
+        # only regions whose bounding box contains the point are actually tested
+        candidates = np.sort(region_tree.query(Point(lon, lat)))
+        matches = candidates[shapely.contains_xy(region_geoms[candidates], lon, lat)]
+        if len(matches):
+            return region_names[matches[0]]  # first region listed if more than one match
     except Exception:
         warn(f'error geolocating: ({lat}, {lon})')
     #warn(f'did not find: ({lat}, {lon})')
     return None
 
+def coords_to_countries(region_shapes, lons, lats, workers=None):
+    """Vectorized `coord_to_country` for arrays of longitudes and latitudes.
+
+    Returns an array of region names with None for coordinates that fall outside of every region.
+    The points are split across `workers` threads (default: one per CPU); shapely releases the GIL
+    while querying so the chunks run in parallel without copying the region geometries.
+    """
+    region_names, region_geoms, region_tree = region_shapes
+    countries = np.full(len(lons), None, dtype=object)
+
+    def query(start, end):
+        # bounding-box candidates from the tree, then exact tests against the prepared geometries
+        point_idx, region_idx = region_tree.query(shapely.points(lons[start:end], lats[start:end]))
+        point_idx = point_idx + start
+        inside = shapely.contains_xy(region_geoms[region_idx], lons[point_idx], lats[point_idx])
+        return point_idx[inside], region_idx[inside]
+
+    workers = min(workers or os.cpu_count() or 1, max(len(lons), 1))
+    bounds = np.linspace(0, len(lons), workers + 1).astype(int)
+    if workers == 1:
+        point_idx, region_idx = query(0, len(lons))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = list(executor.map(query, bounds[:-1], bounds[1:]))
+        point_idx = np.concatenate([p for p, _ in chunks])
+        region_idx = np.concatenate([r for _, r in chunks])
+    if len(point_idx):
+        # keep the first region listed for each point if more than one matches
+        order = np.lexsort((region_idx, point_idx))
+        point_idx, first = np.unique(point_idx[order], return_index=True)
+        countries[point_idx] = np.array(region_names, dtype=object)[region_idx[order][first]]
+    return countries
+
 def get_aggregation_logic(aggregates_tsv):
     """Mapping of regions -> regions not directly associated with them.
 
@@ -395,17 +546,22 @@ def get_region_data(region_qids_tsv, region_geoms_geojson, aggregation_tsv):
     # load in geometries for the regions identified via Wikidata
     with open(region_geoms_geojson, 'r') as fin:
         regions = json.load(fin)['features']
-    region_shapes = []
+    region_names = []
+    region_geoms = []
     skipped = []
     for c in regions:
         qid = c['properties']['WIKIDATAID']
         if qid in qid_to_region:
-            region_shapes.append((qid_to_region[qid], shape(c['geometry'])))
+            region_names.append(qid_to_region[qid])
+            region_geoms.append(shape(c['geometry']))
         else:
             skipped.append('{0} ({1})'.format(c['properties']['NAME'], qid))
-    warn(f"Loaded {len(region_shapes)} region geometries. Skipped {len(skipped)}: {skipped}")
+    warn(f"Loaded {len(region_geoms)} region geometries. Skipped {len(skipped)}: {skipped}")
 
-    return region_shapes
+    # prepared geometries build their point-in-polygon indices once rather than on every test
+    region_geoms = np.array(region_geoms, dtype=object)
+    shapely.prepare(region_geoms)
+    return region_names, region_geoms, STRtree(region_geoms)
 
 if __name__ == '__main__':
     #rebuild()
@@ -1,36 +1,94 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+import gc
 import os
 import re
 import sys
+import threading
 import time
-import traceback
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import mwapi
 import mwparserfromhell as mw
-import tldextract
-from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
 import yaml
 
-__dir__ = os.path.dirname(__file__)
-sys.path.append(__dir__)
+APP_DIR = os.path.dirname(__file__)
+sys.path.append(APP_DIR)
 
 from urltoregion import LogisticInferrer, url2registereddomain
+from urltoregion.gputils import TLD_EXTRACTOR, load_cached
+from urltoregion.gpwhois import cancellable_lookups
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson (much faster for the large `sources` lists).
+
+    Keys stay sorted as with Flask's default provider, but non-ASCII text (e.g., publisher names)
+    is emitted as UTF-8 rather than \\u-escaped.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self.default, option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype)
 
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
 
 INFERRER = LogisticInferrer()
+# one record per citation template; converted to JSON by `source_to_dict`
+Source = collections.namedtuple('Source', ['template', 'publisher', 'url', 'country', 'error'])
+# keep-alive connections to the Wikipedia APIs, shared across requests
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+WIKI_SESSIONS = {}
+WIKI_SESSIONS_LOCK = threading.Lock()
+# domains are geolocated on a pool so that inference from the caches overlaps the one whois lookup in
+# flight -- network lookups themselves are serialized and throttled (see gpwhois.WHOIS_LOCK)
+GEOLOCATION_POOL = ThreadPoolExecutor(max_workers=8)
 PUBLISHERS = {}
+PUBLISHERS_CACHE_VERSION = 1  # bump when read_publishers changes its output
 # generic platforms for hosting content that don't have much geographic meaning
 DOMAIN_SKIP_LIST = {'youtube.com',
                     'google.com',  # Google Books mainly
                     'facebook.com'}
 
-WIKIPEDIA_LANGUAGE_CODES = ['aa', 'ab', 'ace', 'ady', 'af', 'ak', 'als', 'am', 'an', 'ang', 'ar', 'arc', 'ary', 'arz', 'as', 'ast', 'atj', 'av', 'avk', 'awa', 'ay', 'az', 'azb', 'ba', 'ban', 'bar', 'bat-smg', 'bcl', 'be', 'be-x-old', 'bg', 'bh', 'bi', 'bjn', 'bm', 'bn', 'bo', 'bpy', 'br', 'bs', 'bug', 'bxr', 'ca', 'cbk-zam', 'cdo', 'ce', 'ceb', 'ch', 'cho', 'chr', 'chy', 'ckb', 'co', 'cr', 'crh', 'cs', 'csb', 'cu', 'cv', 'cy', 'da', 'de', 'din', 'diq', 'dsb', 'dty', 'dv', 'dz', 'ee', 'el', 'eml', 'en', 'eo', 'es', 'et', 'eu', 'ext', 'fa', 'ff', 'fi', 'fiu-vro', 'fj', 'fo', 'fr', 'frp', 'frr', 'fur', 'fy', 'ga', 'gag', 'gan', 'gcr', 'gd', 'gl', 'glk', 'gn', 'gom', 'gor', 'got', 'gu', 'gv', 'ha', 'hak', 'haw', 'he', 'hi', 'hif', 'ho', 'hr', 'hsb', 'ht', 'hu', 'hy', 'hyw', 'hz', 'ia', 'id', 'ie', 'ig', 'ii', 'ik', 'ilo', 'inh', 'io', 'is', 'it', 'iu', 'ja', 'jam', 'jbo', 'jv', 'ka', 'kaa', 'kab', 'kbd', 'kbp', 'kg', 'ki', 'kj', 'kk', 'kl', 'km', 'kn', 'ko', 'koi', 'kr', 'krc', 'ks', 'ksh', 'ku', 'kv', 'kw', 'ky', 'la', 'lad', 'lb', 'lbe', 'lez', 'lfn', 'lg', 'li', 'lij', 'lld', 'lmo', 'ln', 'lo', 'lrc', 'lt', 'ltg', 'lv', 'mai', 'map-bms', 'mdf', 'mg', 'mh', 'mhr', 'mi', 'min', 'mk', 'ml', 'mn', 'mnw', 'mr', 'mrj', 'ms', 'mt', 'mus', 'mwl', 'my', 'myv', 'mzn', 'na', 'nah', 'nap', 'nds', 'nds-nl', 'ne', 'new', 'ng', 'nl', 'nn', 'no', 'nov', 'nqo', 'nrm', 'nso', 'nv', 'ny', 'oc', 'olo', 'om', 'or', 'os', 'pa', 'pag', 'pam', 'pap', 'pcd', 'pdc', 'pfl', 'pi', 'pih', 'pl', 'pms', 'pnb', 'pnt', 'ps', 'pt', 'qu', 'rm', 'rmy', 'rn', 'ro', 'roa-rup', 'roa-tara', 'ru', 'rue', 'rw', 'sa', 'sah', 'sat', 'sc', 'scn', 'sco', 'sd', 'se', 'sg', 'sh', 'shn', 'si', 'simple', 'sk', 'sl', 'sm', 'smn', 'sn', 'so', 'sq', 'sr', 'srn', 'ss', 'st', 'stq', 'su', 'sv', 'sw', 'szl', 'szy', 'ta', 'tcy', 'te', 'tet', 'tg', 'th', 'ti', 'tk', 'tl', 'tn', 'to', 'tpi', 'tr', 'ts', 'tt', 'tum', 'tw', 'ty', 'tyv', 'udm', 'ug', 'uk', 'ur', 'uz', 've', 'vec', 'vep', 'vi', 'vls', 'vo', 'wa', 'war', 'wo', 'wuu', 'xal', 'xh', 'xmf', 'yi', 'yo', 'za', 'zea', 'zh', 'zh-classical', 'zh-min-nan', 'zh-yue', 'zu']
+# wikitext patterns for counting references
+RE_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+# either a self-closing <ref .../> or a <ref ...>...</ref> pair, matched in one pass
+RE_REF = re.compile(r'<ref(?:\s[^/>]*)?(?:/>|>[\s\S]*?</ref>)', re.I)
+# path component of a URL (what urlparse(url).path gives, minus ;params)
+RE_URL_PATH = re.compile(r'^(?:[a-zA-Z][a-zA-Z0-9+.-]*:)?(?://[^/?#]*)?([^?#]*)')
+# template names (lowercased) that are treated as citations
+CITATION_PREFIXES = ('cite', 'citation')
+CITATION_EXCLUDED_PREFIXES = ('citation needed', 'cite needed')
+# wikitext patterns for locating citation templates without parsing the whole article
+# skips comments and the contents of tags mwparserfromhell leaves unparsed (<math>, <nowiki>, <pre>, ...)
+RE_TEMPLATE_BRACES = re.compile(r'<!--.*?-->|<(%s)\b[^>]*?(?:/>|>.*?</\1\s*>)|\{{2,}|\}{2,}'
+                                % '|'.join(mw.definitions.PARSER_BLACKLIST), re.DOTALL | re.I)
+RE_CITATION_NAME = re.compile(r'\s*cit(?:e|ation)', re.I)
+
+# Wikipedia language editions the API accepts; lang is also the subdomain get_session connects to.
+# Maintained by hand (last refreshed 2026-10): add new editions from
+# https://meta.wikimedia.org/wiki/List_of_Wikipedias as they launch or they are rejected as unsupported.
+WIKIPEDIA_LANGUAGE_CODES = frozenset(['aa', 'ab', 'ace', 'ady', 'af', 'ak', 'als', 'alt', 'am', 'ami', 'an', 'ang', 'ann', 'ar', 'arc', 'ary', 'arz', 'as', 'ast', 'atj', 'av', 'avk', 'awa', 'ay', 'az', 'azb', 'ba', 'ban', 'bar', 'bat-smg', 'bbc', 'bcl', 'bdr', 'be', 'be-x-old', 'bew', 'bg', 'bh', 'bi', 'bjn', 'blk', 'bm', 'bn', 'bo', 'bpy', 'br', 'bs', 'btm', 'bug', 'bxr', 'ca', 'cbk-zam', 'cdo', 'ce', 'ceb', 'ch', 'cho', 'chr', 'chy', 'ckb', 'co', 'cr', 'crh', 'cs', 'csb', 'cu', 'cv', 'cy', 'da', 'dag', 'de', 'dga', 'din', 'diq', 'dsb', 'dtp', 'dty', 'dv', 'dz', 'ee', 'el', 'eml', 'en', 'eo', 'es', 'et', 'eu', 'ext', 'fa', 'fat', 'ff', 'fi', 'fiu-vro', 'fj', 'fo', 'fon', 'fr', 'frp', 'frr', 'fur', 'fy', 'ga', 'gag', 'gan', 'gcr', 'gd', 'gl', 'glk', 'gn', 'gom', 'gor', 'got', 'gpe', 'gu', 'guc', 'gur', 'guw', 'gv', 'ha', 'hak', 'haw', 'he', 'hi', 'hif', 'ho', 'hr', 'hsb', 'ht', 'hu', 'hy', 'hyw', 'hz', 'ia', 'iba', 'id', 'ie', 'ig', 'igl', 'ii', 'ik', 'ilo', 'inh', 'io', 'is', 'it', 'iu', 'ja', 'jam', 'jbo', 'jv', 'ka', 'kaa', 'kab', 'kbd', 'kbp', 'kcg', 'kg', 'kge', 'ki', 'kj', 'kk', 'kl', 'km', 'kn', 'knc', 'ko', 'koi', 'kr', 'krc', 'ks', 'ksh', 'ku', 'kus', 'kv', 'kw', 'ky', 'la', 'lad', 'lb', 'lbe', 'lez', 'lfn', 'lg', 'li', 'lij', 'lld', 'lmo', 'ln', 'lo', 'lrc', 'lt', 'ltg', 'lv', 'mad', 'mai', 'map-bms', 'mdf', 'mg', 'mh', 'mhr', 'mi', 'min', 'mk', 'ml', 'mn', 'mni', 'mnw', 'mos', 'mr', 'mrj', 'ms', 'mt', 'mus', 'mwl', 'my', 'myv', 'mzn', 'na', 'nah', 'nap', 'nds', 'nds-nl', 'ne', 'new', 'ng', 'nia', 'nl', 'nn', 'no', 'nov', 'nqo', 'nr', 'nrm', 'nso', 'nup', 'nv', 'ny', 'oc', 'olo', 'om', 'or', 'os', 'pa', 'pag', 'pam', 'pap', 'pcd', 'pcm', 'pdc', 'pfl', 'pi', 'pih', 'pl', 'pms', 'pnb', 'pnt', 'ps', 'pt', 'pwn', 'qu', 'rm', 'rmy', 'rn', 'ro', 'roa-rup', 'roa-tara', 'rsk', 'ru', 'rue', 'rw', 'sa', 'sah', 'sat', 'sc', 'scn', 'sco', 'sd', 'se', 'sg', 'sh', 'shi', 'shn', 'si', 'simple', 'sk', 'skr', 'sl', 'sm', 'smn', 'sn', 'so', 'sq', 'sr', 'srn', 'ss', 'st', 'stq', 'su', 'sv', 'sw', 'syl', 'szl', 'szy', 'ta', 'tay', 'tcy', 'tdd', 'te', 'tet', 'tg', 'th', 'ti', 'tig', 'tk', 'tl', 'tly', 'tn', 'to', 'tok', 'tpi', 'tr', 'trv', 'ts', 'tt', 'tum', 'tw', 'ty', 'tyv', 'udm', 'ug', 'uk', 'ur', 'uz', 've', 'vec', 'vep', 'vi', 'vls', 'vo', 'wa', 'war', 'wo', 'wuu', 'xal', 'xh', 'xmf', 'yi', 'yo', 'za', 'zea', 'zgh', 'zh', 'zh-classical', 'zh-min-nan', 'zh-yue', 'zu'])
 
 # load in app user-agent or any other app config
 app.config.update(
-    yaml.safe_load(open(os.path.join(__dir__, 'api', 'flask_config.yaml'))))
+    yaml.safe_load(open(os.path.join(APP_DIR, 'api', 'flask_config.yaml'))))
 
 # Enable CORS for API endpoints
 cors = CORS(app, resources={r'/api/*': {'origins': '*'}})
@@ -45,7 +103,7 @@ def url_to_country():
         try:
             domain = url2registereddomain(url)
             result['domain'] = domain
-            result['country'] = url_to_region(url)
+            result['country'] = domain_to_region(domain) if domain else url_to_region(url)
         except Exception:
             result['error'] = True
         finally:
@@ -54,94 +112,219 @@ def url_to_country():
 @app.route('/api/v1/geo-provenance', methods=['GET'])
 def geoprovenance():
     lang, page_title, error = validate_api_args()
+    if not error:
+        page_title, wikitext = get_wikitext(lang, page_title)
+        if page_title is None:
+            error = 'no matching article for <a href="https://{0}.wikipedia.org/wiki/{1}">https://{0}.wikipedia.org/wiki/{1}</a>'.format(lang, request.args['title'])
     if error:
         return jsonify({"error": error})
     else:
-        wikitext = get_wikitext(lang, page_title)
-        results = []
+        article = f'https://{lang}.wikipedia.org/wiki/{page_title}'
         metadata = {'num_ref_tags':count_ref_tags(wikitext)}
-        region_summary = {}
-        domains = {}
-        publishers = set()
-        start = time.time()
-        do_process = True
-        try:
-            for ref, extracted_data in get_references(wikitext):
-                res = {'template':ref}
-                res.update(extracted_data)
-                country = None
-                processed = False
+        region_summary = collections.Counter()
+        sources = iter_sources(wikitext, metadata, region_summary)
+        if request.args.get('format') == 'ndjson':
+            # one line per citation as soon as it is geolocated, then a final line with the summary
+            def generate():
+                for source in sources:
+                    yield app.json.dumps(source_to_dict(source)) + '\n'
+                yield app.json.dumps({'article':article,
+                                      'metadata':metadata,
+                                      'region_summary':region_summary.most_common()}) + '\n'
+            # X-Accel-Buffering: ask the nginx proxy to pass lines through rather than buffer the response
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                            headers={'X-Accel-Buffering': 'no'})
+        results = [source_to_dict(source) for source in sources]
+        return jsonify({'article':article,
+                        'sources':results,
+                        'metadata':metadata,
+                        'region_summary':region_summary.most_common()})
+
+def source_to_dict(source):
+    """JSON form of a `Source` -- publisher, url, and error are only included if present."""
+    res = {'template':source.template}
+    if source.publisher is not None:
+        res['publisher'] = source.publisher
+    if source.url is not None:
+        res['url'] = source.url
+    if source.error:
+        res['error'] = True
+    res['country'] = source.country
+    return res
+
+def iter_sources(wikitext, metadata, region_summary):
+    """Yield the citations (`Source` records) of an article with their inferred country, in order of appearance.
+
+    Domains are geolocated concurrently on the shared thread pool within a 40 second budget.
+    `metadata` and `region_summary` are filled in as the citations are consumed.
+    """
+    domains = set()
+    publishers = set()
+    deadline = time.monotonic() + 40
+    cancelled = threading.Event()  # stops queued lookups from starting whois queries past the deadline
+    # first pass: extract citations and resolve publishers, queueing each new domain for geolocation
+    citations = []
+    futures = {}
+    try:
+        for ref, extracted_data in get_references(wikitext):
+            publisher = extracted_data.get('publisher')
+            url = extracted_data.get('url')
+            country = None
+            domain = None
+            error = False
+            try:
+                if publisher is not None:
+                    pub = publisher.lower()
+                    country = PUBLISHERS.get(pub)
+                    publishers.add(pub)
+                if url is not None and country is None:
+                    domain = url2registereddomain(url)
+                    if domain and domain not in futures:
+                        futures[domain] = GEOLOCATION_POOL.submit(geolocate, domain, cancelled)
+            except Exception:
+                error = True
+            citations.append((Source(ref, publisher, url, country, error), domain))
+    except:  # if processing fails, still return what you have
+        app.logger.exception('failed to extract all citations')
+
+    timed_out = False
+    try:
+        for source, domain in citations:
+            processed = source.publisher is not None
+            future = futures.get(domain)
+            if future is not None and not timed_out:
+                wait([future], timeout=max(deadline - time.monotonic(), 0))
+                if not future.done():
+                    # taking too long: skip lookups that have not started yet; running ones finish
+                    # in the background from the caches but start no further whois queries
+                    timed_out = True
+                    cancelled.set()
+                    for f in futures.values():
+                        f.cancel()
+            if future is not None and future.done() and not future.cancelled():
                 try:
-                    if 'publisher' in extracted_data:
-                        pub = extracted_data['publisher'].lower()
-                        country = PUBLISHERS.get(pub)
-                        processed = True
-                        publishers.add(pub)
-                    if 'url' in extracted_data and country is None:
-                        url = extracted_data['url']
-                        domain = url2registereddomain(url)
-                        if domain and do_process:
-                            country = domains.get(domain, url_to_region(url))
-                            domains[domain] = country
-                            processed = True
+                    source = source._replace(country=future.result())
+                    domains.add(domain)
+                    processed = True
                 except Exception:
-                    res['error'] = True
-                finally:
-                    res['country'] = country
-                    results.append(res)
-                    if country:
-                        region_summary[country] = region_summary.get(country, 0) + 1
-                    else:
-                        region_summary['no_country'] = region_summary.get('no_country', 0) + 1
-                    if not processed:
-                        region_summary['n/a'] = region_summary.get('n/a', 0) + 1
-                    if time.time() - start > 40:
-                        do_process = False  # taking too long, stop processing domains and skip to the end
-        except:  # if processing fails, still return what you have
-            traceback.print_exc()
-            pass
-        finally:
-            metadata['num_cite_templates'] = len(results)
-            metadata['num_unique_domains'] = len(domains)
-            metadata['num_unique_publishers'] = len(publishers)
-            if not do_process:
-                metadata['process_timed_out'] = True
-            return jsonify({'article':f'https://{lang}.wikipedia.org/wiki/{page_title}',
-                            'sources':results,
-                            'metadata':metadata,
-                            'region_summary':[(c, region_summary[c]) for c in sorted(
-                                region_summary, key=region_summary.get, reverse=True)]})
+                    source = source._replace(error=True)
+            country = source.country
+            if country:
+                region_summary[country] += 1
+            else:
+                region_summary['no_country'] += 1
+            if not processed:
+                region_summary['n/a'] += 1
+            yield source
+    finally:
+        # also when the consumer stops early (e.g., an aborted NDJSON stream): leftover lookups must not
+        # keep pool threads busy with whois queries into later requests
+        cancelled.set()
+
+    metadata['num_cite_templates'] = len(citations)
+    metadata['num_unique_domains'] = len(domains)
+    metadata['num_unique_publishers'] = len(publishers)
+    if timed_out:
+        metadata['process_timed_out'] = True
+
+def get_session(lang):
+    """Reusable mwapi session for a Wikipedia language edition.
+
+    All sessions share one requests.Session whose connection pool (up to 64 connections per host) keeps
+    connections alive, so repeat requests skip the TCP/TLS handshake.
+    """
+    session = WIKI_SESSIONS.get(lang)
+    if session is None:
+        with WIKI_SESSIONS_LOCK:
+            session = WIKI_SESSIONS.get(lang)
+            if session is None:
+                session = mwapi.Session(f'https://{lang}.wikipedia.org', user_agent=app.config['CUSTOM_UA'],
+                                        session=HTTP_SESSION)
+                WIKI_SESSIONS[lang] = session
+    return session
 
 def get_wikitext(lang, title):
-    """Gather set of up to `limit` outlinks for an article."""
-    session = mwapi.Session(f'https://{lang}.wikipedia.org', user_agent=app.config['CUSTOM_UA'])
-
-    # generate list of all outlinks (to namespace 0) from the article and their associated Wikidata IDs
-    result = session.get(
-        action="parse",
-        page=title,
-        redirects='',
-        prop='wikitext',
-        format='json',
-        formatversion=2
-    )
+    """Get the canonical title and wikitext of an article, following redirects.
+
+    Returns (None, None) if there is no matching article.
+    """
+    session = get_session(lang)
+
     try:
-        return result['parse']['wikitext']
+        result = session.get(
+            action="parse",
+            page=title,
+            redirects='',
+            prop='wikitext',
+            format='json',
+            formatversion=2
+        )
+    except mwapi.errors.APIError as e:
+        if e.code in ('missingtitle', 'invalidtitle'):
+            return None, None
+        raise  # e.g., maxlag, ratelimited, readonly: not a statement about the article
+    page_title = result['parse']['title'].replace(' ', '_')
+    try:
+        return page_title, result['parse']['wikitext']
     except Exception:
-        traceback.print_exc()
-        return ''
+        app.logger.exception(f'no wikitext returned for {lang}:{page_title}')
+        return page_title, ''
 
 def citation_only(template):
     tn = template.name.strip().lower()
-    return ((tn.startswith('cite') or tn.startswith('citation'))
-            and not tn.startswith('citation needed')
-            and not tn.startswith('cite needed'))
+    return tn.startswith(CITATION_PREFIXES) and not tn.startswith(CITATION_EXCLUDED_PREFIXES)
 
 def count_ref_tags(wikitext):
-    ref_singleton = re.compile(r'<ref(\s[^/>]*)?/>', re.M | re.I)
-    ref_tag = re.compile(r'<ref(\s[^/>]*)?>[\s\S]*?</ref>', re.M | re.I)
-    wikitext = re.sub(r'<!--.*?-->', '', wikitext, flags=re.DOTALL).lower()
-    return len(ref_singleton.findall(wikitext)) + len(ref_tag.findall(wikitext))
+    wikitext = wikitext.lower()
+    # cheap substring checks before running the regexes over the whole article
+    if '<ref' not in wikitext:
+        return 0
+    if '<!--' in wikitext:
+        wikitext = RE_COMMENT.sub('', wikitext)
+    return len(RE_REF.findall(wikitext))
+
+@functools.lru_cache(maxsize=50000)
+def tld_domain(url):
+    """Domain label of a URL (e.g., 'archive' for web.archive.org), memoized as articles cite the same URLs often."""
+    return TLD_EXTRACTOR(url).domain
+
+def iter_citation_spans(wikitext):
+    """Yield the wikitext of every {{cite...}} / {{citation...}} template, including nested ones.
+
+    Runs of braces are matched with a stack so templates nested within the citation (or a citation
+    nested within e.g. an infobox) are handled; anything within HTML comments or within tags whose
+    contents mwparserfromhell does not parse (e.g., <math>, <nowiki>, <pre>) is ignored.
+
+    This only approximates the parser: with unbalanced braces a span may not be a template to
+    mwparserfromhell (e.g., `{{cite<ref/>{{Citation|...}}...}}`), so callers should re-parse each
+    span and skip it unless it is a single template. Malformed markup -- stray braces together with
+    unclosed comments or tags -- can still pair braces differently than parsing the whole article.
+    """
+    spans = []
+    opened = []  # [start, number of braces still open] for each run of opening braces
+    for m in RE_TEMPLATE_BRACES.finditer(wikitext):
+        token = m.group()
+        if token[0] == '{':
+            opened.append([m.start(), len(token)])
+        elif token[0] == '}':
+            end = m.start()
+            closing = len(token)
+            # as in MediaWiki, a closing run is matched against the innermost opening run: three
+            # braces make a {{{parameter}}}, two a {{template}}; a single leftover brace is text
+            while closing >= 2 and opened:
+                run = opened[-1]
+                n = 3 if min(run[1], closing) >= 3 else 2
+                run[1] -= n
+                start = run[0] + run[1]
+                end += n
+                closing -= n
+                if run[1] < 2:
+                    opened.pop()
+                if n == 2 and RE_CITATION_NAME.match(wikitext, start + 2):
+                    spans.append((start, end))
+    # order of appearance (outer templates before the templates nested within them)
+    for start, end in sorted(spans):
+        yield wikitext[start:end]
 
 def get_references(wikitext):
     """Extract list of citation templates from wikitext for an article via simple regex.
@@ -153,16 +336,24 @@ def get_references(wikitext):
     try:
         cite_templates = []
         # with raw regex very hard to detect nested templates -- e.g., citation within an infobox
-        for template in mw.parse(wikitext).ifilter_templates(matches=citation_only):
+        for template in iter_citation_spans(wikitext):
+            wikicode = mw.parse(template)
+            # a span the parser doesn't read as one template (unbalanced braces) is skipped -- the
+            # citations nested within it are spans of their own
+            citation = wikicode.nodes[0] if len(wikicode.nodes) == 1 else None
+            if not isinstance(citation, mw.nodes.Template) or not citation_only(citation):
+                continue
             extracted_data = {}
             try:
                 url = None
-                wikicode = mw.parse(template)
-                # extract publisher info
-                for param in wikicode.filter_templates()[0].params:
-                    if param.name.strip().lower() == 'publisher':
+                url_param = None
+                # extract publisher info and the official url parameter in one pass over the params
+                for param in citation.params:
+                    name = param.name.strip().lower()
+                    if name == 'publisher' and 'publisher' not in extracted_data:
                         extracted_data['publisher'] = param.value.strip_code().strip()
-                        break
+                    elif name == 'url' and url_param is None:
+                        url_param = str(param.value).strip()
                 # extract URL
                 potential_urls = [str(u) for u in wikicode.filter_external_links()]
                 if potential_urls:
@@ -171,20 +362,19 @@ def get_references(wikitext):
                         url = potential_urls[0]
                     # multiple
                     else:
-                        url = None
-                        # look for official url parameter
-                        for param in wikicode.filter_templates()[0].params:
-                            if param.name.strip().lower() == 'url':
-                                url = str(param.value).strip()
-                                break
+                        # use the official url parameter if there is one
+                        url = url_param
                         # multiple but no official URL -- take the first one in template
                         if url is None:
                             url = potential_urls[0]
                     # some final post-processing
                     # if internet archive link, seek to extract original URL out of it
-                    tld = tldextract.extract(url)
-                    if tld.domain == 'archive':
-                        path = urlparse(url).path
+                    if tld_domain(url) == 'archive':
+                        path = RE_URL_PATH.match(url).group(1)
+                        # like urlparse, drop any ;params from the last path segment
+                        params = path.find(';', max(path.rfind('/'), 0))
+                        if params != -1:
+                            path = path[:params]
                         start_of_archived_url = path.find('http')
                         if start_of_archived_url != -1:
                             url = path[start_of_archived_url:]
@@ -199,7 +389,33 @@ def get_references(wikitext):
                yield (str(template), extracted_data)
         return cite_templates
     except Exception:
-        traceback.print_exc()
+        app.logger.exception('failed to extract citation templates')
+
+def test_iter_citation_spans():
+    # nested within an infobox; a citation within a citation
+    assert(list(iter_citation_spans('{{Infobox x|ref={{cite web|url=http://a.com}}}}')) ==
+           ['{{cite web|url=http://a.com}}'])
+    assert(list(iter_citation_spans('{{cite web|url=http://b.org|title={{cite web|url=http://c.net}}}}')) ==
+           ['{{cite web|url=http://b.org|title={{cite web|url=http://c.net}}}}', '{{cite web|url=http://c.net}}'])
+    # comments and tags the parser leaves alone
+    assert(list(iter_citation_spans('<!-- {{cite web|url=http://a.com}} -->')) == [])
+    assert(list(iter_citation_spans('{{cite journal|title=<math>\\frac{a}{b^{2}}</math>|url=http://a.com}}')) ==
+           ['{{cite journal|title=<math>\\frac{a}{b^{2}}</math>|url=http://a.com}}'])
+    assert(list(iter_citation_spans('<nowiki>{{cite web|url=http://a.com}}</nowiki><PRE>{{cite web}}</PRE>')) == [])
+    assert(list(iter_citation_spans('{{cite web|title=<nowiki>}}</nowiki>|url=http://a.com}}')) ==
+           ['{{cite web|title=<nowiki>}}</nowiki>|url=http://a.com}}'])
+    # left unclosed; template parameters
+    assert(list(iter_citation_spans('{{cite web|url=http://a.com {{cite news|url=http://b.com}}')) ==
+           ['{{cite news|url=http://b.com}}'])
+    assert(list(iter_citation_spans('{{cite web|title={{{1}}}}}')) == ['{{cite web|title={{{1}}}}}'])
+
+def test_get_references():
+    assert(list(get_references('{{cite web|url=http://www.bbc.co.uk/news|publisher=[[BBC]]}} {{citation needed}}')) ==
+           [('{{cite web|url=http://www.bbc.co.uk/news|publisher=[[BBC]]}}',
+             {'publisher': 'BBC', 'url': 'http://www.bbc.co.uk/news'})])
+    # with unbalanced braces only the citation the parser finds is returned, not the enclosing span
+    assert([t for t, _ in get_references('{{cite<ref name=x/>{{Citation|url=http://a.com}} http://b.com }}}}')] ==
+           ['{{Citation|url=http://a.com}}'])
 
 def url_to_region(url):
     # conf is a number between 0 and 1.0 indicating confidence
@@ -213,23 +429,18 @@ def url_to_region(url):
     else:
         return None
 
-def get_canonical_page_title(title, lang):
-    """Resolve redirects / normalization -- used to verify that an input page_title exists"""
-    session = mwapi.Session('https://{0}.wikipedia.org'.format(lang), user_agent=app.config['CUSTOM_UA'])
-
-    result = session.get(
-        action="query",
-        prop="info",
-        inprop='',
-        redirects='',
-        titles=title,
-        format='json',
-        formatversion=2
-    )
-    if 'missing' in result['query']['pages'][0]:
-        return None
-    else:
-        return result['query']['pages'][0]['title'].replace(' ', '_')
+def geolocate(domain, cancelled):
+    """`domain_to_region` for the geolocation pool: whois network lookups are skipped once `cancelled` is set."""
+    with cancellable_lookups(cancelled):
+        return domain_to_region(domain)
+
+@functools.lru_cache(maxsize=100000)
+def domain_to_region(domain):
+    """Same as `url_to_region` but for a registered domain -- e.g., nytimes.com.
+
+    The model features only depend on the domain of a URL, so results are cached across requests.
+    """
+    return url_to_region(domain)
 
 def validate_lang(lang):
     return lang in WIKIPEDIA_LANGUAGE_CODES
@@ -241,9 +452,9 @@ def validate_api_args():
     page_title = None
     if request.args.get('title') and request.args.get('lang'):
         lang = request.args['lang']
-        page_title = get_canonical_page_title(request.args['title'], lang)
-        if page_title is None:
-            error = 'no matching article for <a href="https://{0}.wikipedia.org/wiki/{1}">https://{0}.wikipedia.org/wiki/{1}</a>'.format(lang, request.args['title'])
+        page_title = request.args['title']
+        if not validate_lang(lang):
+            error = 'unsupported language "{0}" -- e.g., "en" for English'.format(lang)
     elif request.args.get('lang'):
         error = 'missing an article title -- e.g., "2005_World_Series" for <a href="https://en.wikipedia.org/wiki/2005_World_Series">https://en.wikipedia.org/wiki/2005_World_Series</a>'
     elif request.args.get('title'):
@@ -253,20 +464,31 @@ def validate_api_args():
 
     return lang, page_title, error
 
-def load_publishers():
+def read_publishers(publishers_tsv):
     expected_header = ['publisher', 'country']
-    with open(os.path.join(__dir__, 'urltoregion/data/fullmodel/wikidata_publisher_countries.tsv'), 'r') as fin:
+    publishers = {}
+    with open(publishers_tsv, 'r') as fin:
         assert next(fin).strip().split('\t') == expected_header
         for line in fin:
             line = line.strip().split('\t')
             publisher = line[0]
-            country = line[1]
-            PUBLISHERS[publisher.strip().lower()] = country
+            country = sys.intern(line[1])  # ~250 distinct countries shared by 20k publishers
+            publishers[publisher.strip().lower()] = country
+    return publishers
+
+def load_publishers():
+    # parsed mapping is pickled so later worker starts skip the TSV
+    publishers_tsv = os.path.join(APP_DIR, 'urltoregion/data/fullmodel/wikidata_publisher_countries.tsv')
+    PUBLISHERS.update(load_cached(publishers_tsv, lambda: read_publishers(publishers_tsv),
+                               PUBLISHERS_CACHE_VERSION))
     print(f"Loaded {len(PUBLISHERS)} publishers.")
 
 
 application = app
 load_publishers()
+# the models and lookup tables loaded above live as long as the process: move them out of the
+# garbage collector's reach so uWSGI workers forked from the master keep sharing their pages
+gc.freeze()
 
 if __name__ == '__main__':
     application.run()
\ No newline at end of file